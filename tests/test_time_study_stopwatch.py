@@ -0,0 +1,345 @@
+"""Unit tests for the BigQuery write helpers in time_study_stopwatch.py.
+
+No BigQuery credentials, no network — the client is a local fake and the
+query parameters are checked through their REST representation. Skipped when
+streamlit / google-cloud-bigquery are not installed. The one live check
+(a dry run of _MERGE_QUERY) is opt-in via BQ_DRY_RUN=1 and needs credentials.
+
+Run with: pytest tests/test_time_study_stopwatch.py -v
+"""
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("google.cloud.bigquery")
+pytest.importorskip("streamlit_js_eval")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from google.api_core import exceptions as gcp_exc  # noqa: E402
+
+import time_study_stopwatch as tss  # noqa: E402
+
+
+class _FakeJob:
+    num_dml_affected_rows = 1
+
+    def result(self):
+        return self
+
+
+class _FakeClient:
+    """Raises the queued errors in order, then succeeds."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls  = 0
+
+    def query(self, sql, job_config=None, job_retry=None):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return _FakeJob()
+
+
+class _RejectingClient:
+    """Rejects (accessDenied-style) any MERGE whose batch contains ``bad``."""
+
+    def __init__(self, bad):
+        self.bad     = bad
+        self.batches = []
+
+    def query(self, sql, job_config=None, job_retry=None):
+        params = {p["name"]: p for p in job_config.to_api_repr()["query"]["queryParameters"]}
+        ids = [
+            v["structValues"]["event_id"]["value"]
+            for v in params["rows"]["parameterValue"]["arrayValues"]
+        ]
+        self.batches.append(ids)
+        if self.bad in ids:
+            raise gcp_exc.BadRequest("x", errors=[{"reason": "invalid"}])
+        return _FakeJob()
+
+
+def _row(**overrides):
+    row = {c: None for c, _ in tss._ROW_COLUMNS}
+    row.update(
+        event_id="e1", spv="SPV A", region="R", distributor="D",
+        activity_key="dist_out", activity_label="Check Out Distributor",
+        logged_at=datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+        created_at=datetime(2026, 1, 2, 3, 4, 6, tzinfo=timezone.utc),
+    )
+    row.update(overrides)
+    return row
+
+
+@pytest.fixture(autouse=True)
+def _no_sleep(monkeypatch):
+    monkeypatch.setattr(tss.time, "sleep", lambda _s: None)
+
+
+# =====================================================================
+# UNIT — _is_retryable
+# =====================================================================
+class TestIsRetryable:
+    @pytest.mark.parametrize("exc_cls, reason", [
+        (gcp_exc.Forbidden,  "rateLimitExceeded"),
+        (gcp_exc.Forbidden,  "jobRateLimitExceeded"),
+        (gcp_exc.BadRequest, "resourceInUse"),
+        (gcp_exc.BadRequest, "tableUnavailable"),
+        (gcp_exc.InternalServerError, "backendError"),
+    ])
+    def test_transient_reasons_retry(self, exc_cls, reason):
+        assert tss._is_retryable(exc_cls("x", errors=[{"reason": reason}]))
+
+    @pytest.mark.parametrize("exc_cls, reason", [
+        (gcp_exc.Forbidden,  "accessDenied"),
+        (gcp_exc.BadRequest, "invalidQuery"),
+        (gcp_exc.NotFound,   "notFound"),
+    ])
+    def test_permanent_reasons_do_not_retry(self, exc_cls, reason):
+        assert not tss._is_retryable(exc_cls("x", errors=[{"reason": reason}]))
+
+    def test_no_reason_falls_back_to_status_class(self):
+        assert not tss._is_retryable(gcp_exc.BadRequest("x"))
+        assert tss._is_retryable(gcp_exc.ServiceUnavailable("x"))
+
+
+# =====================================================================
+# UNIT — _insert_with_retry
+# =====================================================================
+class TestInsertWithRetry:
+    def test_rate_limited_403_is_retried(self):
+        client = _FakeClient(gcp_exc.Forbidden("x", errors=[{"reason": "rateLimitExceeded"}]))
+        result = tss._insert_with_retry(client, [_row()])
+        assert result.ok
+        assert client.calls == 2
+
+    def test_permanent_error_stops_after_one_attempt(self):
+        client = _FakeClient(*[gcp_exc.Forbidden("x", errors=[{"reason": "accessDenied"}])] * 3)
+        result = tss._insert_with_retry(client, [_row()])
+        assert not result.ok
+        assert client.calls == 1
+
+
+# =====================================================================
+# UNIT — _MERGE_QUERY parameters
+# =====================================================================
+class TestMergeJobConfig:
+    def _params(self, rows):
+        cfg = tss._merge_job_config(rows)
+        return {p["name"]: p for p in cfg.to_api_repr()["query"]["queryParameters"]}
+
+    def test_source_is_a_subquery(self):
+        # MERGE ... USING takes a table or a parenthesised subquery, not bare UNNEST
+        assert "USING (SELECT * FROM UNNEST(@rows)) S" in tss._MERGE_QUERY
+
+    def test_struct_fields_mirror_row_columns(self):
+        rows_param = self._params([_row()])["rows"]
+        fields = rows_param["parameterType"]["arrayType"]["structTypes"]
+        assert [(f["name"], f["type"]["type"]) for f in fields] == list(tss._ROW_COLUMNS)
+
+    def test_null_fields_serialise_as_null(self):
+        values = self._params([_row()])["rows"]["parameterValue"]["arrayValues"][0]["structValues"]
+        assert values["store_id"] == {"value": None}
+        assert values["latitude"] == {"value": None}
+        assert values["duration_seconds"] == {"value": None}
+        assert values["event_id"] == {"value": "e1"}
+
+    def test_duplicate_event_ids_are_sent_once(self):
+        params = self._params([_row(), _row(spv="SPV B")])
+        assert len(params["rows"]["parameterValue"]["arrayValues"]) == 1
+
+    def test_pruning_bounds_cover_the_batch(self):
+        early  = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        late   = datetime(2026, 1, 3, tzinfo=timezone.utc)
+        params = self._params([
+            _row(event_id="a", logged_at=late, spv="SPV B"),
+            _row(event_id="b", logged_at=early),
+        ])
+        assert params["t0"]["parameterValue"]["value"].startswith("2026-01-01")
+        assert params["t1"]["parameterValue"]["value"].startswith("2026-01-03")
+        assert [v["value"] for v in params["spvs"]["parameterValue"]["arrayValues"]] == [
+            "SPV A", "SPV B",
+        ]
+
+
+# =====================================================================
+# INTEGRATION — dry-run the MERGE against BigQuery (opt-in)
+# =====================================================================
+@pytest.mark.skipif(
+    os.environ.get("BQ_DRY_RUN") != "1",
+    reason="set BQ_DRY_RUN=1 with BigQuery credentials to validate the SQL",
+)
+def test_merge_query_dry_run():
+    client = tss._get_bq_client()
+    assert client is not None, "no BigQuery credentials resolved"
+    cfg = tss._merge_job_config([_row()])
+    cfg.dry_run = True
+    cfg.use_query_cache = False
+    job = client.query(tss._MERGE_QUERY, job_config=cfg, job_retry=None)
+    assert job.state == "DONE"
+
+
+# =====================================================================
+# UNIT — _BackgroundWriter
+# =====================================================================
+class TestBackgroundWriter:
+    @pytest.fixture(autouse=True)
+    def _fast_writer(self, monkeypatch):
+        monkeypatch.setattr(tss.BigQueryConfig, "WRITE_FLUSH_INTERVAL_S", 0.01)
+        monkeypatch.setattr(tss.BigQueryConfig, "WRITE_RETRY_DELAY_S", 0.01)
+
+    @staticmethod
+    def _wait_for(cond, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not cond():
+            assert time.monotonic() < deadline, "timed out waiting for the writer"
+            threading.Event().wait(0.01)   # time.sleep is patched out
+
+    def test_transient_failure_is_requeued_not_dropped(self):
+        rate_limited = gcp_exc.Forbidden("x", errors=[{"reason": "rateLimitExceeded"}])
+        client = _FakeClient(*[rate_limited] * tss.BigQueryConfig.INSERT_MAX_RETRIES)
+        writer = tss._BackgroundWriter(client)
+        assert writer.submit(_row(event_id="e-retry"))
+        self._wait_for(lambda: writer.written_at("e-retry") is not None)
+        assert client.calls == tss.BigQueryConfig.INSERT_MAX_RETRIES + 1
+
+    def test_permanent_rejection_is_reported_failed(self):
+        denied = gcp_exc.Forbidden("x", errors=[{"reason": "accessDenied"}])
+        writer = tss._BackgroundWriter(_FakeClient(denied))
+        assert writer.submit(_row(event_id="e-denied"))
+        self._wait_for(lambda: writer.rejected_row("e-denied") is not None)
+        assert writer.rejected_row("e-denied")["event_id"] == "e-denied"
+
+    def test_one_bad_row_does_not_reject_its_batch(self, monkeypatch):
+        # Long enough that all three rows land in one batch
+        monkeypatch.setattr(tss.BigQueryConfig, "WRITE_FLUSH_INTERVAL_S", 0.5)
+        client = _RejectingClient(bad="e-bad")
+        writer = tss._BackgroundWriter(client)
+        for eid in ("e-ok-1", "e-bad", "e-ok-2"):
+            assert writer.submit(_row(event_id=eid))
+        self._wait_for(lambda: writer.rejected_row("e-bad") is not None)
+        self._wait_for(lambda: writer.written_at("e-ok-1") and writer.written_at("e-ok-2"))
+        assert client.batches[0] == ["e-ok-1", "e-bad", "e-ok-2"]
+
+    def test_resubmitted_row_is_no_longer_rejected(self):
+        writer = tss._BackgroundWriter(_FakeClient())
+        writer._failed["e1"] = _row()
+        assert writer.submit(_row())
+        assert writer.rejected_row("e1") is None
+        self._wait_for(lambda: writer.written_at("e1") is not None)
+
+    def test_written_ids_are_bounded(self, monkeypatch):
+        monkeypatch.setattr(tss.BigQueryConfig, "WRITE_SEEN_MAX", 2)
+        writer = tss._BackgroundWriter(_FakeClient())
+        writer._remember_written(["a", "b", "c"], 1)
+        for eid in ("x", "y", "z"):
+            writer._remember(writer._failed, eid, _row(event_id=eid))
+        assert list(writer._seen) == ["b", "c"]
+        assert list(writer._failed) == ["y", "z"]
+
+
+# =====================================================================
+# UNIT — _write_counts
+# =====================================================================
+class TestWriteCounts:
+    def test_settled_ids_leave_the_session_queue(self, monkeypatch):
+        writer = tss._BackgroundWriter(_FakeClient())
+        writer._remember_written(["a"], 1_000)
+        writer._remember(writer._failed, "b", _row(event_id="b"))
+        ss = SimpleNamespace(
+            writer=writer, queued_event_ids={"a", "b", "c"}, pending_writes=[_row()],
+            saved_count=0, rejected_rows=[], last_saved_ms=None,
+        )
+        monkeypatch.setattr(tss.st, "session_state", ss)
+        assert tss._write_counts() == (1, 1, 2)
+        assert ss.queued_event_ids == {"c"}
+        assert ss.last_saved_ms == 1_000
+        assert [r["event_id"] for r in ss.rejected_rows] == ["b"]
+        assert tss._write_counts() == (1, 1, 2)   # settled ids are not counted twice
+
+
+# =====================================================================
+# UNIT — _load_master_data
+# =====================================================================
+class TestLoadMasterData:
+    def test_storage_api_denied_falls_back_to_rest(self, monkeypatch):
+        pa = pytest.importorskip("pyarrow")
+        table = pa.table({
+            "spv": ["SPV A"], "region": ["R"], "distributor": ["D"],
+            "store_id": ["S1"], "store_name": ["Toko 1"],
+        })
+        calls = []
+
+        class _Rows:
+            def to_arrow(self, create_bqstorage_client=True):
+                calls.append(create_bqstorage_client)
+                if create_bqstorage_client:
+                    raise gcp_exc.PermissionDenied("readsessions.create denied")
+                return table
+
+        class _Job:
+            def result(self, page_size=None):
+                return _Rows()
+
+        class _Client:
+            def query(self, sql, job_config=None):
+                return _Job()
+
+        monkeypatch.setattr(tss, "_get_bq_client", lambda: _Client())
+        tss._load_master_data.clear()
+        master = tss._load_master_data("test-rest-fallback")
+        tss._load_master_data.clear()
+        assert master.ok(), master.error
+        assert calls == [True, False]
+        assert master.spv_list == ["SPV A"]
+
+
+# =====================================================================
+# UNIT — _session_writer
+# =====================================================================
+class TestSessionWriter:
+    def test_missing_client_is_not_cached(self, monkeypatch):
+        clients = [RuntimeError("no credentials"), _FakeClient()]
+
+        def _bq_client():
+            client = clients.pop(0)
+            if isinstance(client, Exception):
+                raise client
+            return client
+
+        ss = SimpleNamespace(writer=None, writer_retry_at=0.0)
+        monkeypatch.setattr(tss, "_bq_client", _bq_client)
+        monkeypatch.setattr(tss.st, "session_state", ss)
+        tss._get_writer.clear()
+        try:
+            assert tss._session_writer() is None
+            assert tss._session_writer() is None   # throttled: no second lookup yet
+            assert clients, "client lookup was not throttled"
+            ss.writer_retry_at = 0.0
+            assert isinstance(tss._session_writer(), tss._BackgroundWriter)
+        finally:
+            tss._get_writer.clear()
+
+
+# =====================================================================
+# UNIT — _new_client
+# =====================================================================
+class TestNewClient:
+    def test_client_uses_keepalive_session(self, monkeypatch):
+        from google.auth.credentials import AnonymousCredentials
+
+        monkeypatch.delenv("GOOGLE_API_USE_CLIENT_CERTIFICATE", raising=False)
+        client  = tss._new_client(AnonymousCredentials(), "proj")
+        adapter = client._http.get_adapter("https://bigquery.googleapis.com")
+        assert isinstance(adapter, tss._KeepAliveAdapter)
+        assert adapter._pool_maxsize == tss.BigQueryConfig.HTTP_POOL_MAXSIZE
+        assert client.project == "proj"
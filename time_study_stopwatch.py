@@ -16,7 +16,13 @@ Environment variables (optional overrides)
     BQ_DATASET                       BigQuery dataset name
     BQ_TABLE                         BigQuery table name
     GOOGLE_APPLICATION_CREDENTIALS   Path to a service-account JSON key file
-    MASTER_DATA_TTL                  Master store data cache TTL in seconds (default 3600)
+    MASTER_DATA_TTL                  Fallback master-data refresh interval in seconds, used
+                                     only when the master table's metadata lookup fails
+                                     (default 3600). Normally the table's last-modified
+                                     time is re-checked every MASTER_VERSION_TTL (60 s)
+                                     and the master data reloads when it changes.
+    MASTER_MAX_BYTES_BILLED          Byte cap on the master-data query (default 1 GB); a
+                                     query that would bill more fails the master load
 
 Credential resolution order
 ----------------------------
@@ -28,20 +34,31 @@ Credential resolution order
 
 from __future__ import annotations
 
+import functools
 import hashlib
 import logging
 import os
+import queue
+import random
+import socket
 import sys
+import threading
 import time
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 
+import google.auth
 import streamlit as st
 from google.api_core import exceptions as gcp_exc
+from google.auth.credentials import Credentials, with_scopes_if_required
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import bigquery
 from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 from streamlit_js_eval import get_geolocation
 
 
@@ -63,14 +80,28 @@ logger = logging.getLogger(__name__)
 # ============================================================
 
 class BigQueryConfig:
-    PROJECT:      str   = os.environ.get("BQ_PROJECT", "skintific-data-warehouse")
-    DATASET:      str   = os.environ.get("BQ_DATASET", "gt_schema")
-    TABLE:        str   = os.environ.get("BQ_TABLE",   "gt_salesman_time_motion")
-    MASTER_TABLE: str   = "master_store_database_basis"
-    INSERT_MAX_RETRIES:   int   = 3
-    INSERT_RETRY_DELAY_S: float = 1.0
-    MASTER_DATA_TTL:      int   = int(os.environ.get("MASTER_DATA_TTL", 3600))
-    GPS_TIMEOUT_S:        int   = 15   # seconds to wait before offering skip
+    PROJECT:                 str   = os.environ.get("BQ_PROJECT", "skintific-data-warehouse")
+    DATASET:                 str   = os.environ.get("BQ_DATASET", "gt_schema")
+    TABLE:                   str   = os.environ.get("BQ_TABLE",   "gt_salesman_time_motion")
+    MASTER_TABLE:            str   = "master_store_database_basis"
+    INSERT_MAX_RETRIES:      int   = 3
+    INSERT_RETRY_DELAY_S:    float = 1.0
+    MASTER_DATA_TTL:         int   = int(os.environ.get("MASTER_DATA_TTL", 3600))
+    MASTER_VERSION_TTL:      int   = 60   # how often to re-check the master table's mtime
+    MASTER_MAX_BYTES_BILLED: int   = int(os.environ.get("MASTER_MAX_BYTES_BILLED", 1_000_000_000))
+    GPS_TIMEOUT_S:           int   = 15   # seconds to wait before offering skip
+    CLIENT_RETRY_S:          int   = 30   # wait before re-resolving credentials after a failure
+    HTTP_POOL_MAXSIZE:       int   = 16
+    HTTP_KEEPALIVE_IDLE_S:   int   = 60   # idle time before the first keep-alive probe
+    HTTP_KEEPALIVE_INTVL_S:  int   = 15   # gap between unanswered probes…
+    HTTP_KEEPALIVE_COUNT:    int   = 4    # …and how many before the socket is dropped
+    WRITE_BATCH_MAX_ROWS:    int   = 500        # flush when this many rows are buffered…
+    WRITE_BATCH_MAX_BYTES:   int   = 5_000_000  # …or the batch reaches ~5 MB…
+    WRITE_FLUSH_INTERVAL_S:  float = 2.0        # …or when the oldest buffered row is this old
+    WRITE_QUEUE_MAX:         int   = 10_000     # bound on rows waiting for the writer thread
+    WRITE_RETRY_DELAY_S:     float = 5.0        # re-queue delay after a transient batch failure…
+    WRITE_RETRY_MAX_S:       float = 300.0      # …doubling per failure up to this cap
+    WRITE_SEEN_MAX:          int   = 100_000    # written event_ids remembered per process
 
     @classmethod
     def full_table(cls) -> str:
@@ -83,6 +114,10 @@ class LocaleConfig:
     TZ_OFFSET: timedelta = timedelta(hours=7)
 
 
+# Hot-path alias — avoid a class-attribute lookup per call
+_TZ: ZoneInfo = LocaleConfig.TZ
+
+
 LOCAL_CREDENTIALS_PATH: str = os.environ.get(
     "GOOGLE_APPLICATION_CREDENTIALS",
     r"C:\Users\Bella Chelsea\Documents\skintific-data-warehouse-ea77119e2e7a.json",
@@ -125,6 +160,12 @@ ACTIVITIES: List[Activity] = [
 
 ACTIVITY_MAP: Dict[str, Activity] = {a.key: a for a in ACTIVITIES}
 
+_ACT_PLACEHOLDER = "— Pilih Aktivitas —"
+_ACT_DISPLAYS: Tuple[str, ...] = tuple(a.display() for a in ACTIVITIES)
+_ACT_SELECT_OPTIONS: Tuple[str, ...] = (_ACT_PLACEHOLDER, *_ACT_DISPLAYS)
+_ACT_KEY_BY_DISPLAY: Dict[str, str] = {d: a.key for d, a in zip(_ACT_DISPLAYS, ACTIVITIES)}
+_ACT_INDEX_BY_KEY: Dict[str, int] = {a.key: i for i, a in enumerate(ACTIVITIES, start=1)}
+
 P1_ACTIONS: List[P1Action] = [
     P1Action("dist_in",  "Check In Distributor",  "📥"),
     P1Action("dist_out", "Check Out Distributor", "📤"),
@@ -134,25 +175,38 @@ P1_ACTIONS: List[P1Action] = [
 
 P1_ACTION_MAP: Dict[str, P1Action] = {a.key: a for a in P1_ACTIONS}
 
+# Selectbox options are invariant — build them once instead of on every rerun
+_P1_PLACEHOLDER = "— Pilih Aktivitas —"
+_P1_DISPLAYS: Tuple[str, ...] = tuple(a.display() for a in P1_ACTIONS)
+_P1_DISPLAY_TO_ACTION: Dict[str, P1Action] = dict(zip(_P1_DISPLAYS, P1_ACTIONS))
+_P1_SELECT_OPTIONS: Tuple[str, ...] = (_P1_PLACEHOLDER, *_P1_DISPLAYS)
+
 
 # ============================================================
 # SQL
 # ============================================================
 
+# Normalisation (trim, NULL → '') and the empty-key filter run in BigQuery,
+# so the loader receives clean, non-null STRING columns only.
 _MASTER_QUERY = f"""
-    SELECT
-        UPPER(spv_g2g)         AS spv,
-        CASE
-            WHEN region_g2g = '' THEN UPPER(region)
-            ELSE UPPER(region_g2g)
-        END                    AS region,
-        UPPER(distributor_g2g) AS distributor,
-        cust_id                AS store_id,
-        store_name
-    FROM `{BigQueryConfig.PROJECT}.{BigQueryConfig.DATASET}.{BigQueryConfig.MASTER_TABLE}`
-    WHERE spv_g2g         <> ''
-      AND spv_g2g         <> '-'
-      AND distributor_g2g <> '-'
+    WITH src AS (
+        SELECT
+            TRIM(UPPER(spv_g2g))         AS spv,
+            CASE
+                WHEN TRIM(region_g2g) = '' THEN TRIM(UPPER(region))
+                ELSE TRIM(UPPER(region_g2g))
+            END                          AS region,
+            TRIM(UPPER(distributor_g2g)) AS distributor,
+            COALESCE(TRIM(CAST(cust_id AS STRING)), '') AS store_id,
+            COALESCE(TRIM(store_name), '')              AS store_name
+        FROM `{BigQueryConfig.PROJECT}.{BigQueryConfig.DATASET}.{BigQueryConfig.MASTER_TABLE}`
+        WHERE spv_g2g         <> ''
+          AND spv_g2g         <> '-'
+          AND distributor_g2g <> '-'
+    )
+    SELECT *
+    FROM src
+    WHERE spv <> '' AND region <> '' AND distributor <> ''
     ORDER BY spv, region, distributor, store_name
 """
 
@@ -180,10 +234,57 @@ PARTITION BY DATE(logged_at)
 CLUSTER BY spv, distributor, store_id
 """
 
-_DEDUP_QUERY = (
-    f"SELECT event_id FROM {BigQueryConfig.full_table()} "
-    f"WHERE event_id IN UNNEST(@ids)"
-)
+# BigQuery error reasons that clear up on their own. Several arrive as 403 /
+# 400 (rate limits as Forbidden, resourceInUse as BadRequest), so retryability
+# is decided from the reason, not the exception class.
+_RETRYABLE_REASONS = frozenset({
+    "backendError",
+    "internalError",
+    "rateLimitExceeded",
+    "jobRateLimitExceeded",
+    "resourceInUse",
+    "tableUnavailable",
+})
+
+# Fallback when an error carries no reason: these status classes never
+# succeed on retry — fail fast instead of sleeping
+_PERMANENT_ERRORS = (gcp_exc.BadRequest, gcp_exc.Forbidden, gcp_exc.NotFound)
+
+# Output row layout (name, BigQuery type) — mirrors _DDL column order
+_ROW_COLUMNS: List[Tuple[str, str]] = [
+    ("event_id",            "STRING"),
+    ("spv",                 "STRING"),
+    ("region",              "STRING"),
+    ("distributor",         "STRING"),
+    ("activity_key",        "STRING"),
+    ("activity_label",      "STRING"),
+    ("logged_at",           "TIMESTAMP"),
+    ("store_id",            "STRING"),
+    ("store_name",          "STRING"),
+    ("duration_seconds",    "INT64"),
+    ("started_at",          "TIMESTAMP"),
+    ("ended_at",            "TIMESTAMP"),
+    ("latitude",            "FLOAT64"),
+    ("longitude",           "FLOAT64"),
+    ("location_accuracy_m", "INT64"),
+    ("created_at",          "TIMESTAMP"),
+    ("device_id",           "STRING"),
+]
+
+# Server-side idempotent insert: one round trip, permanent dedup on event_id.
+# event_id hashes spv + logged_at, so a duplicate always falls inside the
+# batch's logged_at range and spv set — those predicates let BigQuery prune
+# the target to the matching partitions / clustered blocks.
+_MERGE_QUERY = f"""
+MERGE {BigQueryConfig.full_table()} T
+USING (SELECT * FROM UNNEST(@rows)) S
+ON T.event_id = S.event_id
+   AND T.logged_at BETWEEN @t0 AND @t1
+   AND T.spv IN UNNEST(@spvs)
+WHEN NOT MATCHED THEN
+    INSERT ({", ".join(c for c, _ in _ROW_COLUMNS)})
+    VALUES ({", ".join(f"S.{c}" for c, _ in _ROW_COLUMNS)})
+"""
 
 
 # ============================================================
@@ -208,14 +309,6 @@ header    { visibility: hidden; }
     --border:  rgba(255, 255, 255, 0.08);
 }
 
-/* ── Metric cards ── */
-div[data-testid="metric-container"] {
-    background:    var(--surface);
-    border:        1px solid var(--border);
-    border-radius: 12px;
-    padding:       12px 16px;
-}
-
 /* ── Status badges ── */
 .badge {
     display:       inline-block;
@@ -240,6 +333,76 @@ div[data-testid="metric-container"] {
     border:     1px solid rgba(107, 114, 128, 0.3);
 }
 
+/* ── Stopwatch card (static styling lives here, not in the per-tick HTML) ── */
+.sw-card {
+    background:    var(--surface);
+    border:        1px solid var(--border);
+    border-radius: 14px;
+    padding:       24px;
+    text-align:    center;
+    position:      relative;
+    overflow:      hidden;
+}
+.sw-bar {
+    position:   absolute;
+    top: 0; left: 0; right: 0;
+    height:     3px;
+    background: linear-gradient(90deg, #f5a623, #f97316, #e05c5c);
+}
+.sw-caption {
+    font-size:      0.68rem;
+    font-weight:    700;
+    letter-spacing: 2px;
+    text-transform: uppercase;
+    color:          var(--muted);
+    margin-bottom:  4px;
+}
+.sw-activity {
+    font-size:     1.05rem;
+    font-weight:   600;
+    color:         var(--accent);
+    margin-bottom: 12px;
+}
+.sw-clock {
+    font-family:    monospace;
+    font-size:      3.5rem;
+    font-weight:    700;
+    letter-spacing: -2px;
+}
+.sw-running { color: #4ade80; }
+.sw-paused  { color: #f5a623; }
+.sw-idle    { color: #e8eaf0; }
+.sw-status {
+    font-size:      0.72rem;
+    color:          var(--muted);
+    margin-top:     8px;
+    letter-spacing: 1px;
+    text-transform: uppercase;
+}
+
+/* ── Activity totals grid (one element instead of a metric per activity) ── */
+.totals-grid {
+    display:               grid;
+    grid-template-columns: repeat(4, minmax(0, 1fr));
+    gap:                   12px;
+}
+.totals-cell {
+    background:    var(--surface);
+    border:        1px solid var(--border);
+    border-radius: 12px;
+    padding:       12px 16px;
+}
+.totals-label {
+    font-size: 0.8rem;
+    color:     var(--muted);
+}
+.totals-value {
+    font-family: monospace;
+    font-size:   1.6rem;
+    font-weight: 700;
+    color:       #e8eaf0;
+}
+
 /* ── Section label ── */
 .section-label {
     font-size:      0.65rem;
@@ -253,67 +416,61 @@ div[data-testid="metric-container"] {
 """
 
 
-def _stopwatch_card_html(act_name: str, elapsed_fmt: str, color: str, status: str) -> str:
-    return f"""
-<div style="
-    background:    var(--surface);
-    border:        1px solid var(--border);
-    border-radius: 14px;
-    padding:       24px;
-    text-align:    center;
-    position:      relative;
-    overflow:      hidden;
-">
-  <div style="
-      position:   absolute;
-      top: 0; left: 0; right: 0;
-      height:     3px;
-      background: linear-gradient(90deg, #f5a623, #f97316, #e05c5c);
-  "></div>
-  <div style="
-      font-size:      0.68rem;
-      font-weight:    700;
-      letter-spacing: 2px;
-      text-transform: uppercase;
-      color:          var(--muted);
-      margin-bottom:  4px;
-  ">Current Activity</div>
-  <div style="
-      font-size:     1.05rem;
-      font-weight:   600;
-      color:         var(--accent);
-      margin-bottom: 12px;
-  ">{act_name}</div>
-  <div style="
-      font-family:    monospace;
-      font-size:      3.5rem;
-      font-weight:    700;
-      color:          {color};
-      letter-spacing: -2px;
-  ">{elapsed_fmt}</div>
-  <div style="
-      font-size:      0.72rem;
-      color:          var(--muted);
-      margin-top:     8px;
-      letter-spacing: 1px;
-      text-transform: uppercase;
-  ">{status}</div>
-</div>
-"""
+_STOPWATCH_CARD_TPL = (
+    '<div class="sw-card"><div class="sw-bar"></div>'
+    '<div class="sw-caption">Current Activity</div>'
+    '<div class="sw-activity">%(act_name)s</div>'
+    '<div class="sw-clock sw-%(state)s">%(elapsed_fmt)s</div>'
+    '<div class="sw-status">%(status)s</div></div>'
+)
+
+
+_STOPWATCH_STATUS = {"running": "🟢 Recording", "paused": "🟡 Paused", "idle": "○ Idle"}
+
+
+def _stopwatch_card_html(act_name: str, elapsed_fmt: str, state: str) -> str:
+    """state is one of _STOPWATCH_STATUS's keys; it picks the clock colour class."""
+    return _STOPWATCH_CARD_TPL % {
+        "act_name": act_name, "elapsed_fmt": elapsed_fmt,
+        "state": state, "status": _STOPWATCH_STATUS[state],
+    }
+
+
+def _totals_grid_html(items: List[Tuple[str, str]]) -> str:
+    cells = "".join(
+        f'<div class="totals-cell"><div class="totals-label">{label}</div>'
+        f'<div class="totals-value">{value}</div></div>'
+        for label, value in items
+    )
+    return f'<div class="totals-grid">{cells}</div>'
 
 
 # ============================================================
 # Formatting & geo helpers
 # ============================================================
 
-def _fmt_ms(ms: int) -> str:
-    """Format milliseconds as HH:MM:SS."""
-    s = max(int(ms / 1000), 0)
+def _now_ms() -> int:
+    """Wall-clock epoch milliseconds, without building a datetime."""
+    return time.time_ns() // 1_000_000
+
+
+def _mono_ms() -> int:
+    """Monotonic milliseconds — for durations, immune to NTP clock steps."""
+    return time.monotonic_ns() // 1_000_000
+
+
+@functools.lru_cache(maxsize=4096)
+def _fmt_sec(s: int) -> str:
     h, remainder = divmod(s, 3600)
     m, sec = divmod(remainder, 60)
     return f"{h:02d}:{m:02d}:{sec:02d}"
 
 
+def _fmt_ms(ms: int) -> str:
+    """Format milliseconds as HH:MM:SS (memoised per whole second)."""
+    return _fmt_sec(max(int(ms) // 1000, 0))
+
+
 def _geo_label(lat: Optional[float], lng: Optional[float], acc: Optional[int]) -> str:
     if lat is not None and lng is not None:
         acc_str = f" ±{acc}m" if acc is not None else ""
@@ -354,12 +511,21 @@ _STATE_DEFAULTS: Dict[str, Any] = {
     "act_label":        "",
     "timer_running":    False,
     "timer_elapsed_ms": 0,
-    "timer_started_at": None,     # datetime | None
+    "timer_started_ms": None,     # int (monotonic ms) | None
     "totals":           {},       # {activity_key: accumulated_ms}
     "write_phase":      None,     # "dist_in" | "store_session" | None
     "pending_payload":  None,     # dict | None
     "master":           None,     # MasterData | None
+    "master_version":   None,     # _master_version() the master was loaded for
     "gps_requested_at": None,     # float (epoch seconds) | None — when GPS fetch started
+    "gps_polled_at":    0.0,      # float (monotonic) — last GPS poll rerun, for 1 Hz throttle
+    "pending_writes":   [],       # rows not yet accepted by the background writer
+    "writer":           None,     # _BackgroundWriter | None — bound once per session
+    "writer_retry_at":  0.0,      # float (monotonic) — next client retry while writer is None
+    "queued_event_ids": set(),    # event_ids handed to the writer, not yet settled
+    "saved_count":      0,        # this session's rows the writer reported written
+    "rejected_rows":    [],       # this session's rows BigQuery rejected, kept for resending
+    "last_saved_ms":    None,     # int | None — when this session's latest row was written
 }
 
 
@@ -375,22 +541,12 @@ def _init_state() -> None:
 def _spv()              -> str:               return st.session_state.spv
 def _region()           -> str:               return st.session_state.region
 def _distributor()      -> str:               return st.session_state.distributor
-def _store_id()         -> str:               return st.session_state.store_id
-def _store_name()       -> str:               return st.session_state.store_name
-def _act_key()          -> str:               return st.session_state.act_key
-def _act_label()        -> str:               return st.session_state.act_label
 def _timer_running()    -> bool:              return st.session_state.timer_running
-def _timer_elapsed_ms() -> int:               return st.session_state.timer_elapsed_ms
-def _timer_started_at() -> Optional[datetime]: return st.session_state.timer_started_at
-def _totals()           -> Dict[str, int]:    return st.session_state.totals
-def _geo_done()         -> Set[str]:          return st.session_state.store_geo_done
-def _write_phase()      -> Optional[str]:     return st.session_state.write_phase
-def _pending_payload()  -> Optional[dict]:    return st.session_state.pending_payload
 
 
 def _reset_timer() -> None:
     st.session_state.timer_running    = False
-    st.session_state.timer_started_at = None
+    st.session_state.timer_started_ms = None
     st.session_state.timer_elapsed_ms = 0
 
 
@@ -411,6 +567,7 @@ def _clear_write_pipeline() -> None:
     st.session_state.write_phase     = None
     st.session_state.pending_payload = None
     st.session_state.gps_requested_at = None
+    st.session_state.gps_polled_at    = 0.0
 
 
 # ============================================================
@@ -438,36 +595,99 @@ def _creds_from_secrets(key: str) -> Tuple[service_account.Credentials, str]:
     return creds, project
 
 
+def _has_secret(key: str) -> bool:
+    try:
+        return key in st.secrets
+    except Exception:   # no secrets.toml at all
+        return False
+
+
 # ============================================================
 # BigQuery — client factory
 # ============================================================
 
+_KEEPALIVE_SOCKET_OPTIONS: List[Tuple[int, int, int]] = [
+    *HTTPConnection.default_socket_options,
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+if hasattr(socket, "TCP_KEEPIDLE"):   # Linux; other platforms keep OS defaults
+    _KEEPALIVE_SOCKET_OPTIONS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,  BigQueryConfig.HTTP_KEEPALIVE_IDLE_S),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, BigQueryConfig.HTTP_KEEPALIVE_INTVL_S),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT,   BigQueryConfig.HTTP_KEEPALIVE_COUNT),
+    ]
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose sockets send TCP keep-alive probes."""
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        kwargs["socket_options"] = _KEEPALIVE_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _new_client(creds: Credentials, project: str) -> bigquery.Client:
+    """
+    Build a BigQuery client on our own AuthorizedSession with a larger
+    per-host pool (pool_maxsize). Every session and the writer thread share
+    this one cached client; requests' default of 10 connections per host
+    would otherwise drop and re-handshake TLS under concurrency. The number
+    of hosts pooled (pool_connections) is left at the requests default.
+    Idle pooled sockets are kept open with TCP keep-alive so writes after a
+    quiet spell don't find a connection silently dropped by a NAT / LB.
+    The session is then set up for mTLS the way the client would do it; when
+    client certificates are enabled that mounts the mTLS adapter over ours.
+    """
+    creds   = with_scopes_if_required(creds, bigquery.Client.SCOPE)
+    session = AuthorizedSession(creds)
+    session.mount("https://", _KeepAliveAdapter(pool_maxsize=BigQueryConfig.HTTP_POOL_MAXSIZE))
+    session.configure_mtls_channel()
+    return bigquery.Client(credentials=creds, project=project, _http=session)
+
+
 @st.cache_resource(show_spinner=False)
-def _get_bq_client() -> Optional[bigquery.Client]:
+def _bq_client() -> bigquery.Client:
     """
     Resolve credentials and return a cached BigQuery client.
-    Tries four sources in priority order; last resort is ADC.
+    Tries four sources in priority order; last resort is ADC. A source is
+    only attempted when its file / secrets key is actually present.
+    Raises RuntimeError when none works, so the failure is not cached and
+    a later call tries again.
     """
     loaders = [
-        ("local_file",           _creds_from_local),
-        ("gcp_service_account",  lambda: _creds_from_secrets("gcp_service_account")),
-        ("connections_bigquery", lambda: _creds_from_secrets("connections")),
+        ("local_file",           lambda: os.path.exists(LOCAL_CREDENTIALS_PATH),
+                                 _creds_from_local),
+        ("gcp_service_account",  lambda: _has_secret("gcp_service_account"),
+                                 lambda: _creds_from_secrets("gcp_service_account")),
+        ("connections_bigquery", lambda: _has_secret("connections"),
+                                 lambda: _creds_from_secrets("connections")),
     ]
-    for name, fn in loaders:
+    for name, available, fn in loaders:
+        if not available():
+            continue
         try:
             creds, project = fn()
-            client = bigquery.Client(credentials=creds, project=project)
+            client = _new_client(creds, project)
             logger.info("BigQuery client ready via '%s' (project=%s)", name, project)
             return client
         except Exception as exc:
             logger.debug("Credential source '%s' skipped: %s", name, exc)
 
     try:
-        client = bigquery.Client(project=BigQueryConfig.PROJECT)
+        creds, _ = google.auth.default(scopes=bigquery.Client.SCOPE)
+        client   = _new_client(creds, BigQueryConfig.PROJECT)
         logger.info("BigQuery client ready via Application Default Credentials")
         return client
     except Exception as exc:
         logger.error("All credential sources exhausted: %s", exc)
+        raise RuntimeError("No BigQuery credentials available") from exc
+
+
+def _get_bq_client() -> Optional[bigquery.Client]:
+    """The shared BigQuery client, or None while no credential source works."""
+    try:
+        return _bq_client()
+    except RuntimeError:
         return None
 
 
@@ -475,10 +695,18 @@ def _get_bq_client() -> Optional[bigquery.Client]:
 # BigQuery — schema bootstrap
 # ============================================================
 
+@st.cache_resource(show_spinner=False)
+def _create_table_once(_client: bigquery.Client) -> bool:
+    # Raises on failure so the result is not cached and a later session retries
+    _client.query(_DDL).result()
+    logger.info("Schema bootstrap OK: %s", BigQueryConfig.full_table())
+    return True
+
+
 def _ensure_schema(client: bigquery.Client) -> None:
+    """Run the CREATE TABLE IF NOT EXISTS once per process, not per session."""
     try:
-        client.query(_DDL).result()
-        logger.info("Schema bootstrap OK: %s", BigQueryConfig.full_table())
+        _create_table_once(client)
     except gcp_exc.GoogleAPIError as exc:
         logger.error("Schema bootstrap failed: %s", exc)
 
@@ -487,21 +715,80 @@ def _ensure_schema(client: bigquery.Client) -> None:
 # BigQuery — master data
 # ============================================================
 
-@dataclass
+# _MASTER_QUERY is constant text, so repeat loads within 24 h are served
+# from BigQuery's results cache (no bytes billed). INTERACTIVE priority is
+# kept on purpose: BATCH jobs can sit queued for minutes on a cold start.
+_MASTER_JOB_CONFIG = bigquery.QueryJobConfig(
+    use_query_cache=True,
+    use_legacy_sql=False,
+    maximum_bytes_billed=BigQueryConfig.MASTER_MAX_BYTES_BILLED,
+)
+
+_STORE_PLACEHOLDER = "— Pilih Toko —"
+
+Store = Tuple[str, str]   # (store_id, store_name)
+
+
+@dataclass(slots=True, frozen=True)
+class StoreIndex:
+    """Store picker options and lookups, built once per master-data load."""
+    options:     Tuple[str, ...]  = (_STORE_PLACEHOLDER,)
+    by_label:    Dict[str, Store] = field(default_factory=dict)
+    index_by_id: Dict[str, int]   = field(default_factory=dict)   # store_id → options index
+
+
+def _build_store_index(stores: Tuple[Store, ...]) -> StoreIndex:
+    options:     List[str]        = [_STORE_PLACEHOLDER]
+    by_label:    Dict[str, Store] = {}
+    index_by_id: Dict[str, int]   = {}
+    for s in stores:
+        sid, sname = s
+        label = f"{sname} ({sid})"
+        if label in by_label:
+            continue
+        by_label[label] = s
+        index_by_id.setdefault(sid, len(options))
+        options.append(label)
+    return StoreIndex(options=tuple(options), by_label=by_label, index_by_id=index_by_id)
+
+
+@dataclass(slots=True, frozen=True)
 class MasterData:
-    spv_list:   List[str]
-    by_spv:     Dict[str, Any]
-    all_stores: List[Dict] = field(default_factory=list)  # flat list, independent of SPV hierarchy
-    error:      Optional[str] = None
+    spv_list:    List[str]
+    by_spv:      Dict[str, Any]
+    all_stores:  Tuple[Store, ...] = ()   # flat list, independent of SPV hierarchy
+    store_index: StoreIndex        = field(default_factory=StoreIndex)
+    error:       Optional[str]     = None
 
     def ok(self) -> bool:
         return self.error is None
 
 
-@st.cache_resource(ttl=BigQueryConfig.MASTER_DATA_TTL, show_spinner=False)
-def _load_master_data() -> MasterData:
+@st.cache_data(ttl=BigQueryConfig.MASTER_VERSION_TTL, show_spinner=False)
+def _master_version() -> str:
+    """
+    Cache key for the master data: the master table's last-modified time
+    (a metadata GET — no query, nothing billed). If metadata is unavailable,
+    fall back to a MASTER_DATA_TTL-wide time bucket, i.e. the old TTL.
+    """
+    client = _get_bq_client()
+    if client is not None:
+        try:
+            table = client.get_table(
+                f"{BigQueryConfig.PROJECT}.{BigQueryConfig.DATASET}.{BigQueryConfig.MASTER_TABLE}"
+            )
+            if table.modified is not None:
+                return table.modified.isoformat()
+        except gcp_exc.GoogleAPIError as exc:
+            logger.warning("Master table metadata lookup failed: %s", exc)
+    return f"ttl-{int(time.time()) // BigQueryConfig.MASTER_DATA_TTL}"
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _load_master_data(version: str) -> MasterData:
     """
-    Load the full store hierarchy from BigQuery and cache for MASTER_DATA_TTL seconds.
+    Load the full store hierarchy from BigQuery, cached per master-table
+    version (see _master_version) so edits show up within a minute.
     Also builds a flat deduplicated store list (all_stores) that is not filtered
     by SPV / Region / Distributor, so the store picker shows every store.
     On failure, returns a MasterData with the error field set so callers
@@ -509,54 +796,52 @@ def _load_master_data() -> MasterData:
     """
     client = _get_bq_client()
     if client is None:
-        return MasterData(spv_list=[], by_spv={}, all_stores=[], error="Cannot connect to BigQuery.")
+        return MasterData(spv_list=[], by_spv={}, all_stores=(), error="Cannot connect to BigQuery.")
 
     try:
-        rows = list(client.query(_MASTER_QUERY).result())
+        # Read API (gRPC + Arrow) when google-cloud-bigquery-storage is present.
+        # The client only falls back to paged REST when that package is
+        # missing; a service account without bigquery.readsessions.create
+        # gets a 403 (gRPC PermissionDenied, a Forbidden subclass) instead.
+        job = client.query(_MASTER_QUERY, job_config=_MASTER_JOB_CONFIG)
+        try:
+            table = job.result(page_size=10_000).to_arrow(create_bqstorage_client=True)
+        except gcp_exc.Forbidden as exc:
+            logger.warning("Storage Read API denied, reading master data over REST: %s", exc)
+            table = job.result(page_size=10_000).to_arrow(create_bqstorage_client=False)
     except gcp_exc.GoogleAPIError as exc:
         logger.error("Master data query failed: %s", exc)
-        return MasterData(spv_list=[], by_spv={}, all_stores=[], error=str(exc))
-
-    by_spv: Dict[str, Any] = {}
-    seen_store_ids: Set[str] = set()
-    all_stores: List[Dict] = []
-
-    for row in rows:
-        spv   = (row.spv         or "").strip()
-        reg   = (row.region      or "").strip()
-        dist  = (row.distributor or "").strip()
-        sid   = str(row.store_id or "").strip()
-        sname = (row.store_name  or "").strip()
+        return MasterData(spv_list=[], by_spv={}, all_stores=(), error=str(exc))
 
-        if not (spv and reg and dist):
-            continue
+    df = table.to_pandas()   # already trimmed / filtered by _MASTER_QUERY
 
-        # ── Build SPV hierarchy (used for setup page dropdowns) ──
+    # ── Build SPV hierarchy (used for setup page dropdowns) ──
+    # sort=False keeps the query's ORDER BY for regions / distributors
+    by_spv: Dict[str, Any] = {}
+    for (spv, reg, dist), group in df.groupby(["spv", "region", "distributor"], sort=False):
         spv_node = by_spv.setdefault(spv, {"regions": [], "by_region": {}})
-        if reg not in spv_node["regions"]:
+        reg_node = spv_node["by_region"].get(reg)
+        if reg_node is None:
             spv_node["regions"].append(reg)
+            reg_node = spv_node["by_region"][reg] = {"distributors": [], "by_dist": {}}
+        reg_node["distributors"].append(dist)
 
-        reg_node = spv_node["by_region"].setdefault(
-            reg, {"distributors": [], "by_dist": {}}
-        )
-        if dist not in reg_node["distributors"]:
-            reg_node["distributors"].append(dist)
-
-        store_list: List[Dict] = reg_node["by_dist"].setdefault(dist, [])
-        if sid not in {s["store_id"] for s in store_list}:
-            store_list.append({"store_id": sid, "store_name": sname})
+        stores = group.drop_duplicates("store_id")
+        reg_node["by_dist"][dist] = tuple(zip(stores["store_id"], stores["store_name"]))
 
-        # ── Build flat store list (used for the store picker — no SPV filter) ──
-        if sid and sid not in seen_store_ids:
-            seen_store_ids.add(sid)
-            all_stores.append({"store_id": sid, "store_name": sname})
-
-    all_stores.sort(key=lambda s: s["store_name"])
+    # ── Build flat store list (used for the store picker — no SPV filter) ──
+    flat = (
+        df.loc[df["store_id"] != "", ["store_id", "store_name"]]
+          .drop_duplicates("store_id")
+          .sort_values("store_name", kind="stable")
+    )
+    all_stores: Tuple[Store, ...] = tuple(zip(flat["store_id"], flat["store_name"]))
 
     return MasterData(
         spv_list=sorted(by_spv.keys()),
         by_spv=by_spv,
         all_stores=all_stores,
+        store_index=_build_store_index(all_stores),
     )
 
 
@@ -564,86 +849,347 @@ def _load_master_data() -> MasterData:
 # BigQuery — write helpers
 # ============================================================
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class WriteResult:
-    ok:       bool
-    message:  str
-    inserted: int = 0
-    skipped:  int = 0
+    ok:        bool
+    message:   str
+    inserted:  int  = 0
+    skipped:   int  = 0
+    queued:    int  = 0
+    retryable: bool = False   # failed, but only on transient errors
 
 
 def _make_event_id(spv: str, key: str, store_id: Optional[str], ts: datetime) -> str:
     raw = f"{spv}|{key}|{store_id or ''}|{ts.isoformat()}"
-    return hashlib.sha256(raw.encode()).hexdigest()
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
 
 
-def _to_wib(dt: Optional[datetime]) -> Optional[datetime]:
-    return dt.astimezone(LocaleConfig.TZ) if dt else None
+def _struct_param(row: Dict[str, Any]) -> bigquery.StructQueryParameter:
+    return bigquery.StructQueryParameter(
+        None,
+        *(bigquery.ScalarQueryParameter(c, t, row.get(c)) for c, t in _ROW_COLUMNS),
+    )
 
 
-def _serialise(row: Dict[str, Any]) -> Dict[str, Any]:
-    return {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in row.items()}
+def _merge_job_config(rows: List[Dict[str, Any]]) -> bigquery.QueryJobConfig:
+    """Query parameters for _MERGE_QUERY (rows deduplicated by event_id)."""
+    unique    = list({r["event_id"]: r for r in rows}.values())
+    logged_at = [r["logged_at"] for r in unique]
+    return bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ArrayQueryParameter("rows", "STRUCT", [_struct_param(r) for r in unique]),
+            bigquery.ScalarQueryParameter("t0", "TIMESTAMP", min(logged_at)),
+            bigquery.ScalarQueryParameter("t1", "TIMESTAMP", max(logged_at)),
+            bigquery.ArrayQueryParameter("spvs", "STRING", sorted({r["spv"] for r in unique})),
+        ]
+    )
 
 
-def _fetch_existing_ids(client: bigquery.Client, ids: List[str]) -> Set[str]:
-    if not ids:
-        return set()
-    job_cfg = bigquery.QueryJobConfig(
-        query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", ids)]
-    )
-    try:
-        return {r.event_id for r in client.query(_DEDUP_QUERY, job_config=job_cfg).result()}
-    except gcp_exc.GoogleAPIError as exc:
-        logger.warning("Dedup query failed (skipping pre-dedup): %s", exc)
-        return set()
+def _is_retryable(exc: gcp_exc.GoogleAPIError) -> bool:
+    """True if ``exc`` is worth retrying, judged by its BigQuery error reason."""
+    errors = getattr(exc, "errors", None) or []
+    first  = errors[0] if errors else None
+    reason = first.get("reason") if isinstance(first, dict) else None
+    if reason:
+        return reason in _RETRYABLE_REASONS
+    return not isinstance(exc, _PERMANENT_ERRORS)
 
 
 def _insert_with_retry(client: bigquery.Client, rows: List[Dict[str, Any]]) -> WriteResult:
     """
-    Streaming insert with client-side pre-dedup, server-side idempotency
-    via row_ids, and exponential back-off retry on transient errors.
+    Idempotent insert via a single parameterised MERGE on event_id, with
+    jittered exponential back-off retry on transient errors (see
+    _is_retryable). Permanent errors abort immediately.
     """
-    existing = _fetch_existing_ids(client, [r["event_id"] for r in rows])
-    new_rows = [r for r in rows if r["event_id"] not in existing]
-    skipped  = len(rows) - len(new_rows)
-
-    if not new_rows:
-        return WriteResult(ok=True, message="ℹ️ Semua record sudah tersimpan.", skipped=skipped)
-
-    serialised = [_serialise(r) for r in new_rows]
-    row_ids    = [r["event_id"] for r in new_rows]
-    table_ref  = BigQueryConfig.full_table().strip("`")
+    job_cfg    = _merge_job_config(rows)
     last_error: Optional[str] = None
+    attempt    = 0
+    retryable  = True
 
     for attempt in range(1, BigQueryConfig.INSERT_MAX_RETRIES + 1):
         try:
-            errors = client.insert_rows_json(table_ref, serialised, row_ids=row_ids)
-            if not errors:
-                msg = f"✅ {len(new_rows)} record tersimpan."
-                if skipped:
-                    msg += f" ({skipped} duplikat dilewati)"
-                logger.info("Insert OK: %d rows, %d skipped", len(new_rows), skipped)
-                return WriteResult(ok=True, message=msg, inserted=len(new_rows), skipped=skipped)
-            last_error = str(errors)
-            logger.warning("Insert attempt %d errors: %s", attempt, last_error)
+            # job_retry=None: this loop is the only job-level retry, so a failing
+            # MERGE runs at most INSERT_MAX_RETRIES times, not that × the
+            # library's own re-run policy. Rate-limited jobs (403) are still
+            # retried here — _is_retryable goes by reason, not status class.
+            job      = client.query(_MERGE_QUERY, job_config=job_cfg, job_retry=None)
+            job.result()
+            inserted = job.num_dml_affected_rows or 0
+            skipped  = len(rows) - inserted
+            if not inserted:
+                return WriteResult(ok=True, message="ℹ️ Semua record sudah tersimpan.", skipped=skipped)
+            msg = f"✅ {inserted} record tersimpan."
+            if skipped:
+                msg += f" ({skipped} duplikat dilewati)"
+            logger.info("Insert OK: %d rows, %d skipped", inserted, skipped)
+            return WriteResult(ok=True, message=msg, inserted=inserted, skipped=skipped)
         except gcp_exc.GoogleAPIError as exc:
             last_error = str(exc)
             logger.warning("Insert attempt %d exception: %s", attempt, last_error)
+            if not _is_retryable(exc):
+                retryable = False
+                break
 
         if attempt < BigQueryConfig.INSERT_MAX_RETRIES:
-            delay = BigQueryConfig.INSERT_RETRY_DELAY_S * (2 ** (attempt - 1))
+            # Jitter (0.5×–1.5×) keeps concurrent sessions from retrying in lock-step
+            delay = (
+                BigQueryConfig.INSERT_RETRY_DELAY_S
+                * (2 ** (attempt - 1))
+                * (0.5 + random.random())
+            )
             logger.info("Retrying in %.1fs…", delay)
             time.sleep(delay)
 
     return WriteResult(
         ok=False,
         message=(
-            f"❌ Insert gagal setelah {BigQueryConfig.INSERT_MAX_RETRIES} "
-            f"percobaan: {last_error}"
+            f"❌ Insert gagal setelah {attempt} percobaan: {last_error}"
         ),
+        retryable=retryable,
     )
 
 
+# ============================================================
+# BigQuery — background writer
+# ============================================================
+
+class _BackgroundWriter:
+    """
+    Daemon thread that drains a bounded queue of rows and writes them in
+    batches — one MERGE per flush instead of one per user action. A batch
+    is flushed once it reaches WRITE_BATCH_MAX_ROWS rows or
+    WRITE_BATCH_MAX_BYTES, or once its first row has waited
+    WRITE_FLUSH_INTERVAL_S seconds. Event ids written by this process are
+    remembered so re-submitted rows skip the round trip; the MERGE still
+    dedups against anything written elsewhere.
+
+    A batch that fails on transient errors is put back on the queue after
+    an exponential back-off (WRITE_RETRY_DELAY_S … WRITE_RETRY_MAX_S), so a
+    BigQuery outage delays rows instead of dropping them. A batch that is
+    rejected outright is bisected until the offending rows are isolated, so
+    one bad row does not sink the other sessions' rows batched with it.
+    Rejected rows are logged and kept (see rejected_row) so their session
+    can send them again.
+    """
+
+    def __init__(self, client: bigquery.Client) -> None:
+        self._client = client
+        self._queue: queue.Queue = queue.Queue(maxsize=BigQueryConfig.WRITE_QUEUE_MAX)
+        # Mutated by the writer thread (submit() only drops a resent id from
+        # _failed). _seen maps event_id → epoch ms written, _failed maps
+        # event_id → rejected row; both evict oldest past WRITE_SEEN_MAX
+        # (_seen only saves round trips — the MERGE is the real dedup).
+        self._seen:     OrderedDict[str, int]            = OrderedDict()
+        self._failed:   OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self._attempts: Dict[str, int]        = {}      # failed flushes so far, per event_id
+        self._thread = threading.Thread(target=self._run, name="bq-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, row: Dict[str, Any]) -> bool:
+        """Queue a row without blocking; False if the queue is full."""
+        try:
+            self._queue.put_nowait(row)
+            self._failed.pop(row["event_id"], None)   # a resent row is in flight again
+            return True
+        except queue.Full:
+            return False
+
+    def written_at(self, event_id: str) -> Optional[int]:
+        """Epoch ms the row was written, or None if not (yet) written."""
+        return self._seen.get(event_id)
+
+    def rejected_row(self, event_id: str) -> Optional[Dict[str, Any]]:
+        """The row BigQuery rejected for this event id, or None."""
+        return self._failed.get(event_id)
+
+    def _next_batch(self) -> List[Dict[str, Any]]:
+        first    = self._queue.get()
+        batch    = [first]
+        size     = _approx_row_bytes(first)
+        deadline = time.monotonic() + BigQueryConfig.WRITE_FLUSH_INTERVAL_S
+        while (
+            len(batch) < BigQueryConfig.WRITE_BATCH_MAX_ROWS
+            and size < BigQueryConfig.WRITE_BATCH_MAX_BYTES
+        ):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                row = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(row)
+            size += _approx_row_bytes(row)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = [r for r in self._next_batch() if r["event_id"] not in self._seen]
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        ids = [r["event_id"] for r in batch]
+        try:
+            result = _insert_with_retry(self._client, batch)
+        except Exception:
+            # Network-level failures (timeouts, resets) — transient
+            logger.exception("Background write of %d rows crashed", len(batch))
+            self._retry_later(batch)
+            return
+        if result.ok:
+            self._remember_written(ids, _now_ms())
+        elif result.retryable:
+            logger.warning("Background write of %d rows failed: %s", len(batch), result.message)
+            self._retry_later(batch)
+            return
+        elif len(batch) > 1:
+            # Don't let one bad row reject rows from unrelated sessions
+            mid = len(batch) // 2
+            self._flush(batch[:mid])
+            self._flush(batch[mid:])
+            return
+        else:
+            logger.error("Background write rejected: %s — row: %r", result.message, batch[0])
+            self._remember(self._failed, ids[0], batch[0])
+        for eid in ids:
+            self._attempts.pop(eid, None)
+
+    def _remember_written(self, ids: List[str], written_ms: int) -> None:
+        for eid in ids:
+            self._remember(self._seen, eid, written_ms)
+            self._failed.pop(eid, None)
+
+    @staticmethod
+    def _remember(store: OrderedDict, event_id: str, value: Any) -> None:
+        store[event_id] = value
+        while len(store) > BigQueryConfig.WRITE_SEEN_MAX:
+            store.popitem(last=False)
+
+    def _retry_later(self, batch: List[Dict[str, Any]]) -> None:
+        """Put a transiently failed batch back on the queue after a back-off."""
+        attempt = 1 + max(self._attempts.get(r["event_id"], 0) for r in batch)
+        for row in batch:
+            self._attempts[row["event_id"]] = attempt
+        delay = min(
+            BigQueryConfig.WRITE_RETRY_DELAY_S * (2 ** (attempt - 1)),
+            BigQueryConfig.WRITE_RETRY_MAX_S,
+        )
+        logger.info("Re-queueing %d rows in %.0fs (failure #%d)", len(batch), delay, attempt)
+        timer = threading.Timer(delay, self._requeue, args=(batch,))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, batch: List[Dict[str, Any]]) -> None:
+        # Runs on the timer thread; a full queue just delays the retry further
+        for row in batch:
+            self._queue.put(row)
+
+
+def _approx_row_bytes(row: Dict[str, Any]) -> int:
+    """Cheap upper-bound estimate of a row's size in the MERGE request."""
+    return len(repr(row))
+
+
+@st.cache_resource(show_spinner=False)
+def _get_writer() -> _BackgroundWriter:
+    """Process-wide writer thread, shared by all sessions. Raises (uncached) without a client."""
+    return _BackgroundWriter(_bq_client())
+
+
+def _session_writer() -> Optional[_BackgroundWriter]:
+    """
+    The shared writer, bound into session state on first use. While no
+    client can be built this returns None, retrying at most every
+    CLIENT_RETRY_S so the 1 s status poll doesn't re-resolve credentials.
+    """
+    ss     = st.session_state
+    writer = ss.writer
+    if writer is None and time.monotonic() >= ss.writer_retry_at:
+        try:
+            writer = ss.writer = _get_writer()
+        except RuntimeError:
+            ss.writer_retry_at = time.monotonic() + BigQueryConfig.CLIENT_RETRY_S
+    return writer
+
+
+def _enqueue_rows(rows: List[Dict[str, Any]]) -> WriteResult:
+    """
+    Hand rows to the background writer and return immediately. Rows that
+    cannot be queued (no client, queue full) are parked in
+    ``st.session_state.pending_writes`` and retried on the next rerun.
+    """
+    writer  = _session_writer()
+    pending = st.session_state.pending_writes
+    ids     = st.session_state.queued_event_ids
+    queued  = 0
+    for row in rows:
+        if writer is not None and writer.submit(row):
+            ids.add(row["event_id"])
+            queued += 1
+        else:
+            pending.append(row)
+
+    parked = len(pending)
+    if writer is None:
+        return WriteResult(
+            ok=False,
+            message=f"⚠️ Tidak dapat terhubung ke BigQuery — {parked} record menunggu dikirim ulang.",
+        )
+    if parked:
+        return WriteResult(
+            ok=False,
+            message=f"⚠️ Antrean penuh — {parked} record menunggu dikirim ulang.",
+            queued=queued,
+        )
+    return WriteResult(ok=True, message=f"⏳ {queued} record masuk antrean simpan.", queued=queued)
+
+
+def _drain_pending_writes() -> None:
+    """Re-submit rows parked in session state by an earlier _enqueue_rows."""
+    pending: List[Dict[str, Any]] = st.session_state.pending_writes
+    if not pending:
+        return
+    writer = _session_writer()
+    if writer is None:
+        return
+    ids = st.session_state.queued_event_ids
+    while pending and writer.submit(pending[0]):
+        ids.add(pending.pop(0)["event_id"])
+
+
+def _write_counts() -> Tuple[int, int, int]:
+    """
+    (saved, rejected, waiting) for rows queued by this session. Ids the writer
+    has settled are moved out of ``queued_event_ids`` (rejected rows into
+    ``rejected_rows``), so each poll only looks at rows still in flight.
+    """
+    ss     = st.session_state
+    writer = ss.writer
+    ids    = ss.queued_event_ids
+    if writer is not None:
+        for eid in list(ids):
+            written_ms = writer.written_at(eid)
+            if written_ms is not None:
+                ids.discard(eid)
+                ss.saved_count  += 1
+                ss.last_saved_ms = max(ss.last_saved_ms or 0, written_ms)
+                continue
+            row = writer.rejected_row(eid)
+            if row is not None:
+                ids.discard(eid)
+                ss.rejected_rows.append(row)
+    return ss.saved_count, len(ss.rejected_rows), len(ids) + len(ss.pending_writes)
+
+
+def _resend_rejected() -> None:
+    """Move this session's rejected rows back into the write queue."""
+    ss = st.session_state
+    ss.pending_writes.extend(ss.rejected_rows)
+    ss.rejected_rows = []
+    _drain_pending_writes()
+
+
 # ============================================================
 # BigQuery — public write API
 # ============================================================
@@ -660,12 +1206,8 @@ def _write_checkin_event(
     lng: Optional[float] = None,
     acc: Optional[int]   = None,
 ) -> WriteResult:
-    """Persist a P1 check-in / check-out point event (instantaneous, no duration)."""
-    client = _get_bq_client()
-    if client is None:
-        return WriteResult(ok=False, message="Tidak dapat terhubung ke BigQuery.")
-
-    logged_at = _to_wib(datetime.fromtimestamp(event_time_ms / 1000, tz=timezone.utc))
+    """Queue a P1 check-in / check-out point event (instantaneous, no duration)."""
+    logged_at = datetime.fromtimestamp(event_time_ms / 1000, tz=_TZ)
     row: Dict[str, Any] = {
         "event_id":            _make_event_id(spv, action_key, None, logged_at),
         "spv":                 spv,
@@ -685,7 +1227,7 @@ def _write_checkin_event(
         "created_at":          datetime.now(timezone.utc),
         "device_id":           None,
     }
-    return _insert_with_retry(client, [row])
+    return _enqueue_rows([row])
 
 
 def _write_activity_session(
@@ -698,19 +1240,15 @@ def _write_activity_session(
     store_id: Optional[str],
     store_name: str,
     duration_ms: int,
-    ended_at_iso: str,
+    ended_at_ms: int,
     lat: Optional[float] = None,
     lng: Optional[float] = None,
     acc: Optional[int]   = None,
 ) -> WriteResult:
-    """Persist a timed store-visit activity session."""
-    client = _get_bq_client()
-    if client is None:
-        return WriteResult(ok=False, message="Tidak dapat terhubung ke BigQuery.")
-
+    """Queue a timed store-visit activity session."""
     dur_s   = int(duration_ms / 1000)
-    ended   = _to_wib(datetime.fromisoformat(ended_at_iso.replace("Z", "+00:00")))
-    started = (ended - timedelta(seconds=dur_s)) if ended and dur_s else None
+    ended   = datetime.fromtimestamp(ended_at_ms / 1000, tz=_TZ)
+    started = (ended - timedelta(seconds=dur_s)) if dur_s else None
     sid     = store_id or None
 
     row: Dict[str, Any] = {
@@ -732,7 +1270,7 @@ def _write_activity_session(
         "created_at":          datetime.now(timezone.utc),
         "device_id":           None,
     }
-    return _insert_with_retry(client, [row])
+    return _enqueue_rows([row])
 
 
 # ============================================================
@@ -741,21 +1279,23 @@ def _write_activity_session(
 
 def _get_live_ms() -> int:
     """Current elapsed ms, including any in-progress running interval."""
-    if _timer_running() and _timer_started_at():
-        delta = datetime.now(timezone.utc) - _timer_started_at()
-        return _timer_elapsed_ms() + int(delta.total_seconds() * 1000)
-    return _timer_elapsed_ms()
+    ss         = st.session_state
+    base_ms    = ss.timer_elapsed_ms
+    started_ms = ss.timer_started_ms
+    if ss.timer_running and started_ms is not None:
+        return base_ms + _mono_ms() - started_ms
+    return base_ms
 
 
-def _get_stores() -> List[Dict]:
+def _get_store_index() -> StoreIndex:
     """
-    Return all stores from the master data, independent of the selected
-    SPV / Region / Distributor hierarchy.
+    Return the store picker index over all stores in the master data,
+    independent of the selected SPV / Region / Distributor hierarchy.
     """
     master: Optional[MasterData] = st.session_state.get("master")
     if not master:
-        return []
-    return master.all_stores
+        return StoreIndex()
+    return master.store_index
 
 
 # ============================================================
@@ -784,7 +1324,7 @@ def _commit_write(
             lat=lat, lng=lng, acc=acc,
         )
         if result.ok:
-            st.success(f"📥 **{payload['action_label']}** disimpan · {geo_note}")
+            st.success(f"📥 **{payload['action_label']}** · {geo_note} — {result.message}")
         else:
             st.error(result.message)
 
@@ -801,7 +1341,7 @@ def _commit_write(
             store_id=payload.get("store_id"),
             store_name=payload.get("store_name", "—"),
             duration_ms=payload["duration_ms"],
-            ended_at_iso=payload["ended_at"],
+            ended_at_ms=payload["ended_at_ms"],
             lat=lat, lng=lng, acc=acc,
         )
         if result.ok:
@@ -832,18 +1372,19 @@ def _handle_write_phase() -> bool:
     Returns True if a write phase was active (caller must return to halt
     further rendering).
     """
-    if _write_phase() is None:
+    ss    = st.session_state
+    phase = ss.write_phase
+    if phase is None:
         return False
 
     # Record when we first entered this phase (for elapsed-time display)
-    if st.session_state.gps_requested_at is None:
-        st.session_state.gps_requested_at = time.monotonic()
+    if ss.gps_requested_at is None:
+        ss.gps_requested_at = time.monotonic()
 
     loc = get_geolocation()
     lat, lng, acc = _extract_coords(loc)
 
-    payload = _pending_payload()
-    phase   = _write_phase()
+    payload = ss.pending_payload
 
     # ── GPS arrived → commit with coordinates ──────────────────────────
     if lat is not None:
@@ -853,7 +1394,7 @@ def _handle_write_phase() -> bool:
         return True
 
     # ── GPS not yet available → auto-skip after timeout ────────────────
-    elapsed_s = int(time.monotonic() - (st.session_state.gps_requested_at or 0))
+    elapsed_s = int(time.monotonic() - (ss.gps_requested_at or 0))
     remaining = BigQueryConfig.GPS_TIMEOUT_S - elapsed_s
 
     if remaining <= 0:
@@ -869,8 +1410,13 @@ def _handle_write_phase() -> bool:
         "Pastikan izin lokasi diaktifkan di browser/perangkat Anda."
     )
 
-    # Keep re-polling every second while waiting
-    time.sleep(1)
+    # Keep re-polling at most once per second while waiting. The geolocation
+    # component can trigger its own reruns, so sleep only for the remainder
+    # of the current 1 s window instead of a full second on every pass.
+    wait = 1.0 - (time.monotonic() - ss.gps_polled_at)
+    if wait > 0:
+        time.sleep(wait)
+    ss.gps_polled_at = time.monotonic()
     st.rerun()
     return True
 
@@ -880,12 +1426,17 @@ def _handle_write_phase() -> bool:
 # ============================================================
 
 def _bootstrap() -> None:
-    """Load master data and ensure the output table exists (once per session)."""
-    if st.session_state.get("master") is not None:
+    """Load master data (again only if the table changed) and ensure the output table exists."""
+    ss      = st.session_state
+    version = _master_version()
+    if ss.get("master") is not None and ss.master_version == version:
         return
 
     with st.spinner("⏳ Memuat data dari BigQuery…"):
-        st.session_state.master = _load_master_data()
+        ss.master         = _load_master_data(version)
+        ss.master_version = version
+    if not ss.master.ok():
+        _load_master_data.clear()   # don't pin a failed load to this version
 
     client = _get_bq_client()
     if client:
@@ -952,6 +1503,11 @@ def _page_checkin() -> None:
     with c2:
         st.info(f"**{_spv()}**  \n{_distributor()} · {_region()}")
 
+    if _write_counts()[2]:
+        _write_status_ticking()
+    else:
+        _write_status()
+
     tab_p1, tab_p2 = st.tabs(["📍 Check In/Out", "📋 Activities"])
     with tab_p1:
         _tab_p1()
@@ -967,6 +1523,34 @@ def _page_checkin() -> None:
         st.rerun()
 
 
+def _write_status() -> int:
+    """One-line save status for this session's rows; returns the waiting count."""
+    saved, rejected, waiting = _write_counts()
+    if waiting:
+        st.caption(f"⏳ {waiting} record dalam antrean simpan…")
+    elif rejected:
+        st.caption(f"❌ {rejected} record gagal disimpan ke BigQuery.")
+        if st.button("🔁 Kirim Ulang", key="resend_rejected"):
+            _resend_rejected()
+            st.rerun()
+    elif saved:
+        flushed = datetime.fromtimestamp(st.session_state.last_saved_ms / 1000, tz=_TZ)
+        st.caption(f"✅ {saved} record tersimpan · terakhir {flushed:%H:%M:%S}")
+    return waiting
+
+
+def _write_status_live() -> None:
+    # Fragment reruns skip main(), so retry parked rows here too. Once
+    # everything is flushed, rerun the app so the static line takes over.
+    _drain_pending_writes()
+    if not _write_status():
+        st.rerun()
+
+
+# Polls the writer once a second, but only while this session has rows waiting
+_write_status_ticking = st.fragment(_write_status_live, run_every=1.0)
+
+
 # ============================================================
 # Tab: P1 — Check In / Out
 # ============================================================
@@ -974,38 +1558,33 @@ def _page_checkin() -> None:
 def _tab_p1() -> None:
     st.markdown("#### 📋 Catat Aktivitas Check In/Out")
 
-    display_map = {a.display(): a for a in P1_ACTIONS}
-    chosen = st.selectbox(
-        "Pilih Aktivitas",
-        ["— Pilih Aktivitas —"] + [a.display() for a in P1_ACTIONS],
-        key="p1_sel",
-    )
+    chosen = st.selectbox("Pilih Aktivitas", _P1_SELECT_OPTIONS, key="p1_sel")
 
     if st.button("✅ Catat Waktu", type="primary", use_container_width=True):
-        if chosen == "— Pilih Aktivitas —":
+        if chosen == _P1_PLACEHOLDER:
             st.warning("Pilih aktivitas terlebih dahulu!")
             return
 
-        action        = display_map[chosen]
-        event_time_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        ss            = st.session_state
+        action        = _P1_DISPLAY_TO_ACTION[chosen]
+        event_time_ms = _now_ms()
 
         if action.key == "dist_in":
             # Requires GPS — defer to two-phase writer
-            st.session_state.pending_payload = {
+            ss.pending_payload = {
                 "action_key":    action.key,
                 "action_label":  action.label,
                 "event_time_ms": event_time_ms,
             }
-            st.session_state.write_phase     = "dist_in"
-            st.session_state.gps_requested_at = None   # reset timer
+            ss.write_phase      = "dist_in"
+            ss.gps_requested_at = None   # reset timer
             st.rerun()
         else:
-            with st.spinner("Menyimpan…"):
-                result = _write_checkin_event(
-                    spv=_spv(), region=_region(), distributor=_distributor(),
-                    action_key=action.key, action_label=action.label,
-                    event_time_ms=event_time_ms,
-                )
+            result = _write_checkin_event(
+                spv=ss.spv, region=ss.region, distributor=ss.distributor,
+                action_key=action.key, action_label=action.label,
+                event_time_ms=event_time_ms,
+            )
             if result.ok:
                 st.success(f"{action.icon} **{action.label}** — {result.message}")
             else:
@@ -1019,28 +1598,25 @@ def _tab_p1() -> None:
 def _tab_p2() -> None:
     # ── Store selector ────────────────────────────────────────────────────
     st.markdown("#### 🏪 Pilih Toko")
-    stores     = _get_stores()   # all stores, not filtered by SPV hierarchy
-    store_opts = {f"{s['store_name']} ({s['store_id']})": s for s in stores}
-    cur_label  = next(
-        (k for k, v in store_opts.items() if v["store_id"] == _store_id()), ""
-    )
-
-    choice = st.selectbox(
+    ss       = st.session_state
+    store_id = ss.store_id
+    index    = _get_store_index()   # all stores, not filtered by SPV hierarchy
+    choice   = st.selectbox(
         "Cari / Pilih Toko",
-        ["— Pilih Toko —"] + list(store_opts.keys()),
-        index=(list(store_opts.keys()).index(cur_label) + 1 if cur_label else 0),
+        index.options,
+        index=index.index_by_id.get(store_id, 0),
         key="p2_store_sel",
     )
-    if choice != "— Pilih Toko —":
-        s = store_opts[choice]
-        if s["store_id"] != _store_id():
-            st.session_state.store_id   = s["store_id"]
-            st.session_state.store_name = s["store_name"]
+    if choice != _STORE_PLACEHOLDER:
+        sid, sname = index.by_label[choice]
+        if sid != store_id:
+            store_id = ss.store_id = sid
+            ss.store_name          = sname
 
-    if _store_id():
+    if store_id:
         col_geo, col_reset = st.columns([3, 1])
         with col_geo:
-            if _store_id() in _geo_done():
+            if store_id in ss.store_geo_done:
                 st.markdown(
                     '<span class="badge badge-geo-ok">📍 Lokasi toko sudah terekam</span>',
                     unsafe_allow_html=True,
@@ -1064,39 +1640,43 @@ def _tab_p2() -> None:
     # ── Activity selector ─────────────────────────────────────────────────
     st.markdown("#### 🗂 Stopwatch Aktivitas")
 
-    act_list    = ["— Pilih Aktivitas —"] + [a.display() for a in ACTIVITIES]
-    act_key_map = {a.display(): a.key for a in ACTIVITIES}
-    cur_act     = ""
-    if _act_key():
-        a = ACTIVITY_MAP.get(_act_key())
-        if a:
-            cur_act = a.display()
-
+    act_key    = ss.act_key
     act_choice = st.selectbox(
         "Pilih Aktivitas",
-        act_list,
-        index=(act_list.index(cur_act) if cur_act in act_list else 0),
+        _ACT_SELECT_OPTIONS,
+        index=_ACT_INDEX_BY_KEY.get(act_key, 0),
         key="p2_act_sel",
     )
-    if act_choice != "— Pilih Aktivitas —":
-        new_key = act_key_map[act_choice]
-        if new_key != _act_key():
-            if _timer_running():
-                st.session_state.timer_elapsed_ms = _get_live_ms()
+    if act_choice != _ACT_PLACEHOLDER:
+        new_key = _ACT_KEY_BY_DISPLAY[act_choice]
+        if new_key != act_key:
+            if ss.timer_running:
+                ss.timer_elapsed_ms = _get_live_ms()
                 _reset_timer()
             a = ACTIVITY_MAP[new_key]
-            st.session_state.act_key          = new_key
-            st.session_state.act_label        = a.display()
-            st.session_state.timer_elapsed_ms = 0
+            ss.act_key          = new_key
+            ss.act_label        = a.display()
+            ss.timer_elapsed_ms = 0
 
-    # ── Stopwatch display ─────────────────────────────────────────────────
+    if ss.timer_running:
+        _live_panel_ticking()
+    else:
+        _live_panel()
+
+
+def _live_panel() -> None:
+    """Stopwatch card, Start / Stop controls and per-activity totals."""
+    ss       = st.session_state
+    running  = ss.timer_running
+    act_key  = ss.act_key
     elapsed  = _get_live_ms()
-    act_name = _act_label() or "— None Selected —"
-    color    = "#4ade80" if _timer_running() else ("#f5a623" if elapsed > 0 else "#e8eaf0")
-    status   = "🟢 Recording" if _timer_running() else ("🟡 Paused" if elapsed > 0 else "○ Idle")
+
+    # ── Stopwatch display ─────────────────────────────────────────────────
+    act_name = ss.act_label or "— None Selected —"
+    state    = "running" if running else ("paused" if elapsed > 0 else "idle")
 
     st.markdown(
-        _stopwatch_card_html(act_name, _fmt_ms(elapsed), color, status),
+        _stopwatch_card_html(act_name, _fmt_ms(elapsed), state),
         unsafe_allow_html=True,
     )
 
@@ -1106,39 +1686,37 @@ def _tab_p2() -> None:
         if st.button(
             "▶ Start",
             type="primary",
-            disabled=_timer_running() or not _act_key(),
+            disabled=running or not act_key,
             use_container_width=True,
         ):
-            if not _store_id():
+            if not ss.store_id:
                 st.warning("Pilih toko terlebih dahulu!")
             else:
-                st.session_state.timer_running    = True
-                st.session_state.timer_started_at = datetime.now(timezone.utc)
+                ss.timer_running    = True
+                ss.timer_started_ms = _mono_ms()
                 st.rerun()
 
     with c2:
         if st.button("⏹ Stop & Save", type="secondary", use_container_width=True):
             _stop_and_save()
 
-    # Auto-refresh every second while timer is live
-    if _timer_running():
-        time.sleep(1)
-        st.rerun()
-
     # ── Activity totals ───────────────────────────────────────────────────
     st.divider()
     st.markdown(
         '<div class="section-label">📊 Total Waktu Per Aktivitas</div>',
         unsafe_allow_html=True,
     )
-    live = _get_live_ms()
-    cols = st.columns(4)
-    for i, a in enumerate(ACTIVITIES):
-        total = _totals().get(a.key, 0)
-        if _act_key() == a.key:
-            total += live
-        with cols[i % 4]:
-            st.metric(a.display(), _fmt_ms(total))
+    totals = ss.totals
+    items  = [
+        (d, _fmt_ms(totals.get(a.key, 0) + (elapsed if a.key == act_key else 0)))
+        for d, a in zip(_ACT_DISPLAYS, ACTIVITIES)
+    ]
+    st.markdown(_totals_grid_html(items), unsafe_allow_html=True)
+
+
+# While the timer is live only this panel re-executes each second — the store
+# and activity selectors above it are not re-rendered on every tick.
+_live_panel_ticking = st.fragment(_live_panel, run_every=1.0)
 
 
 # ============================================================
@@ -1146,47 +1724,49 @@ def _tab_p2() -> None:
 # ============================================================
 
 def _stop_and_save() -> None:
+    ss       = st.session_state
     elapsed  = _get_live_ms()
-    store_id = _store_id()
+    store_id = ss.store_id
+    act_key  = ss.act_key
 
-    if elapsed <= 0 or not _act_key():
+    if elapsed <= 0 or not act_key:
         _reset_timer()
         _reset_activity()
         st.rerun()
         return
 
     payload = {
-        "activity_key":   _act_key(),
-        "activity_label": _act_label(),
+        "activity_key":   act_key,
+        "activity_label": ss.act_label,
         "store_id":       store_id,
-        "store_name":     _store_name() or "—",
+        "store_name":     ss.store_name or "—",
         "duration_ms":    elapsed,
-        "ended_at":       datetime.now(timezone.utc).isoformat(),
+        "ended_at_ms":    _now_ms(),
     }
 
     # Accumulate totals before resetting state
-    st.session_state.totals[_act_key()] = _totals().get(_act_key(), 0) + elapsed
+    totals          = ss.totals
+    totals[act_key] = totals.get(act_key, 0) + elapsed
 
     _reset_timer()
     _reset_activity()
 
-    if store_id and store_id not in _geo_done():
+    if store_id and store_id not in ss.store_geo_done:
         # First activity for this store → attempt GPS capture (optional)
-        st.session_state.pending_payload  = payload
-        st.session_state.write_phase      = "store_session"
-        st.session_state.gps_requested_at = None   # reset timer for new phase
+        ss.pending_payload  = payload
+        ss.write_phase      = "store_session"
+        ss.gps_requested_at = None   # reset timer for new phase
         st.rerun()
     else:
-        with st.spinner("Menyimpan…"):
-            result = _write_activity_session(
-                spv=_spv(), region=_region(), distributor=_distributor(),
-                activity_key=payload["activity_key"],
-                activity_label=payload["activity_label"],
-                store_id=payload.get("store_id"),
-                store_name=payload["store_name"],
-                duration_ms=payload["duration_ms"],
-                ended_at_iso=payload["ended_at"],
-            )
+        result = _write_activity_session(
+            spv=ss.spv, region=ss.region, distributor=ss.distributor,
+            activity_key=payload["activity_key"],
+            activity_label=payload["activity_label"],
+            store_id=payload.get("store_id"),
+            store_name=payload["store_name"],
+            duration_ms=payload["duration_ms"],
+            ended_at_ms=payload["ended_at_ms"],
+        )
         if result.ok:
             st.success(
                 f"✅ **{payload['activity_label']}** — "
@@ -1212,6 +1792,7 @@ st.markdown(_APP_CSS, unsafe_allow_html=True)
 
 def main() -> None:
     _init_state()
+    _drain_pending_writes()
 
     # GPS two-phase handler must run first — halts rendering until resolved
     if _handle_write_phase():